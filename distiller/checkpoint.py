@@ -0,0 +1,50 @@
+import atexit
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Dict, Union
+
+import torch
+from safetensors.torch import load_file, save_file
+from torch import Tensor, nn
+
+from distiller.distributed import unwrap
+
+# one writer thread, saving runs off the training loop
+_ckpt_pool = ThreadPoolExecutor(max_workers=1)
+_ckpt_future:Future = None
+
+
+def snapshot(model:nn.Module) -> Dict[str, Tensor]:
+    r"""
+    CPU copy of the weights of `model`,
+    cheaper than copy.deepcopy(model): no module, no extra GPU memory
+    contiguous (channels_last weights are not) as safetensors requires
+    """
+    return {k: v.detach().to('cpu', memory_format=torch.contiguous_format, copy=True) 
+            for k, v in unwrap(model).state_dict().items()}
+
+
+def wait_saves() -> None:
+    r"""block until the pending save is on disk, re-raise its error if any"""
+    if _ckpt_future is not None:
+        _ckpt_future.result()
+
+
+def save_async(state_dict:Dict[str, Tensor], path:str) -> None:
+    r"""
+    save_file(state_dict, path) in a background thread, safetensors writes
+    all tensors in one pass instead of pickling them one by one.
+    `state_dict` must not change afterwards, pass a snapshot()
+    """
+    global _ckpt_future
+    wait_saves() # at most one save in flight
+    _ckpt_future = _ckpt_pool.submit(save_file, state_dict, path)
+
+
+def load_weights(path:str, device:Union[str, torch.device]='cpu') -> Dict[str, Tensor]:
+    r"""state_dict from a .safetensors file, or from a torch.save file (.pth)"""
+    if path.endswith('.safetensors'):
+        return load_file(path, device=str(device))
+    return torch.load(path, map_location=device)
+
+
+atexit.register(wait_saves)
@@ -0,0 +1,58 @@
+from typing import Callable, List, Tuple
+
+import torch
+from torch import Tensor, nn, optim
+
+# https://pytorch.org/docs/stable/notes/cuda.html#cuda-graphs
+
+
+def capture_train_step(forward_loss:Callable[..., Tuple[Tensor, Tensor]], model:nn.Module,
+                       optimizer:optim.Optimizer, *inputs:Tensor, n_warmup:int=3
+                       ) -> Tuple[torch.cuda.CUDAGraph, List[Tensor], Tensor, Tensor]:
+    r"""
+    Record forward, backward and optimizer step into one CUDA graph.
+    `forward_loss(*inputs)` must return (outp, loss) of `model`, the optimizer must
+    be built with capturable=True (and a tensor lr to be scheduled), and every replay
+    must use the shapes of `inputs`. The warmup steps are rolled back, `model` and
+    the optimizer come out as they went in.
+
+    Returns:
+        graph, static_inputs, static_outp, static_loss
+        copy each new batch into static_inputs then call graph.replay()
+    """
+    static_inputs = [x.clone() for x in inputs]
+    model_state = {k: v.clone() for k, v in model.state_dict().items()}
+    optim_state = {p: {k: v.clone() for k, v in state.items()} 
+                   for p, state in optimizer.state.items()}
+
+    # warmup on a side stream so lazy inits (cudnn, optimizer state) are not captured
+    s = torch.cuda.Stream()
+    s.wait_stream(torch.cuda.current_stream())
+    with torch.cuda.stream(s):
+        for _ in range(n_warmup):
+            optimizer.zero_grad(set_to_none=True)
+            _, loss = forward_loss(*static_inputs)
+            loss.backward()
+            optimizer.step()
+    torch.cuda.current_stream().wait_stream(s)
+
+    # undo the warmup updates (weights, BN stats, Adam moments) in place,
+    # the graph keeps the addresses of these tensors
+    with torch.no_grad():
+        for k, v in model.state_dict().items():
+            v.copy_(model_state[k])
+        for p, state in optimizer.state.items():
+            for k, v in state.items():
+                if p in optim_state:
+                    v.copy_(optim_state[p][k])
+                else: # created by the warmup, Adam starts from zeros
+                    v.zero_()
+
+    graph = torch.cuda.CUDAGraph()
+    optimizer.zero_grad(set_to_none=True)
+    with torch.cuda.graph(graph):
+        static_outp, static_loss = forward_loss(*static_inputs)
+        static_loss.backward()
+        optimizer.step()
+
+    return graph, static_inputs, static_outp, static_loss
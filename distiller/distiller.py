@@ -12,6 +12,7 @@ from torch.nn.modules.loss import _Loss
 from torch.utils.data import DataLoader
 
 from .loss import KDLoss
+from distiller.checkpoint import save_async, snapshot, wait_saves
 from distiller.print_utils import print_msg, print_time, desc
 
 
@@ -68,12 +69,12 @@ def train(loaders:Dict[str, DataLoader], dataset_sizes:Dict[str, int], device:to
                 
                 #save checkpoint
                 if not batch_num % ckpt:
-                    path_save = osp.join(folder_save, '{}_{}.pth'.format(
+                    path_save = osp.join(folder_save, '{}_{}.safetensors'.format(
                         teacher.__class__.__name__, batch_num))
-                    torch.save(teacher.state_dict(), path_save)
+                    save_async(snapshot(teacher), path_save)
                     
             epoch_loss = running_loss / dataset_sizes[phase]
-            epoch_acc = running_corrects.double() / dataset_sizes[phase]
+            epoch_acc = running_corrects.item() / dataset_sizes[phase]
             
             if phase == 'train':
                 scheduler.step(100. * epoch_acc) #acc
@@ -89,9 +90,9 @@ def train(loaders:Dict[str, DataLoader], dataset_sizes:Dict[str, int], device:to
             if phase == 'val' and epoch_acc > best_acc:
                 best_acc = epoch_acc
                 best_teacher = copy.deepcopy(teacher)
-                path_save = osp.join(folder_save, '{}_best.pth'.format(
+                path_save = osp.join(folder_save, '{}_best.safetensors'.format(
                     teacher.__class__.__name__))
-                torch.save(teacher.state_dict(), path_save)
+                save_async(snapshot(teacher), path_save)
                 
     return best_teacher, best_acc
 
@@ -142,8 +143,8 @@ def train_kd_4(loaders:Dict[str, DataLoader], dataset_sizes:Dict[str, int], devi
 
                     #save checkpoint
                     if not batch_num % ckpt:
-                        path_save = osp.join(folder_save, '{}_{}.pth'.format(model_name, batch_num))
-                        torch.save(student.state_dict(), path_save)
+                        path_save = osp.join(folder_save, '{}_{}.safetensors'.format(model_name, batch_num))
+                        save_async(snapshot(student), path_save)
                         
                     running_loss += loss.item()*datas.size(0)
                     running_corrects += torch.sum(pred == targets.data)
@@ -157,7 +158,7 @@ def train_kd_4(loaders:Dict[str, DataLoader], dataset_sizes:Dict[str, int], devi
                     stream.update()
                 
                 epoch_loss = running_loss / dataset_sizes[phase]
-                epoch_acc = running_corrects.double() / dataset_sizes[phase]
+                epoch_acc = running_corrects.item() / dataset_sizes[phase]
                 
                 stream.set_description(
                     desc(epoch, epochs, phase, epoch_loss, epoch_acc))
@@ -175,8 +176,8 @@ def train_kd_4(loaders:Dict[str, DataLoader], dataset_sizes:Dict[str, int], devi
             if phase == 'val' and epoch_acc > best_acc:
                 best_acc = epoch_acc
                 best_student = copy.deepcopy(student)
-                path_save = osp.join(folder_save, '{}_best.pth'.format(model_name))
-                torch.save(student.state_dict(), path_save)
+                path_save = osp.join(folder_save, '{}_best.safetensors'.format(model_name))
+                save_async(snapshot(student), path_save)
         
     return best_student, best_acc
 
@@ -228,8 +229,8 @@ def train_kd(loaders:Dict[str, DataLoader], dataset_sizes:Dict[str, int], device
 
                     #save checkpoint
                     if not batch_num % ckpt:
-                        path_save = osp.join(folder_save, '{}_{}.pth'.format(model_name, batch_num))
-                        torch.save(student.state_dict(), path_save)
+                        path_save = osp.join(folder_save, '{}_{}.safetensors'.format(model_name, batch_num))
+                        save_async(snapshot(student), path_save)
                         
                     running_loss += loss.item()*datas.size(0)
                     running_corrects += torch.sum(pred == targets.data)
@@ -243,7 +244,7 @@ def train_kd(loaders:Dict[str, DataLoader], dataset_sizes:Dict[str, int], device
                     stream.update()
                 
                 epoch_loss = running_loss / dataset_sizes[phase]
-                epoch_acc = running_corrects.double() / dataset_sizes[phase]
+                epoch_acc = running_corrects.item() / dataset_sizes[phase]
                 
                 stream.set_description(
                     desc(epoch, epochs, phase, epoch_loss, epoch_acc))
@@ -261,8 +262,8 @@ def train_kd(loaders:Dict[str, DataLoader], dataset_sizes:Dict[str, int], device
             if phase == 'val' and epoch_acc > best_acc:
                 best_acc = epoch_acc
                 best_student = copy.deepcopy(student)
-                path_save = osp.join(folder_save, '{}_best.pth'.format(model_name))
-                torch.save(student.state_dict(), path_save)
+                path_save = osp.join(folder_save, '{}_best.safetensors'.format(model_name))
+                save_async(snapshot(student), path_save)
         
     return best_student, best_acc
 
@@ -325,8 +326,9 @@ class _Distiller(object):
                                           self.student, best_acc, 
                                           self.criterion, optimizer, scheduler,
                                           epochs, model_name, ckpt)
-        last_student = osp.join(folder_save, '{}_last.pth'.format(model_name))
-        torch.save(self.student.state_dict(), last_student)
+        last_student = osp.join(folder_save, '{}_last.safetensors'.format(model_name))
+        save_async(snapshot(self.student), last_student)
+        wait_saves()
         time_elapsed = time() - since
         print('ALL NET TRAINING TIME {} m {:.3f}s'.format(
             time_elapsed//60, time_elapsed % 60))
@@ -340,13 +342,13 @@ class Distiller(object):
     teacher = resnet34(pretrained=True, progress=True)
     teacher.fc = nn.Linear(in_features=teacher.fc.in_features,
                            out_features=num_classes, bias=True)
-    teacher.load_state_dict(torch.load('path/to/teacher.pth'))
+    teacher.load_state_dict(load_weights('path/to/teacher.safetensors'))
     
     # create student, resnet18
     student = resnet18(pretrained=True, progress=True)
     student.fc = nn.Linear(in_features=teacher.fc.in_features,
                            out_features=num_classes, bias=True)
-    student.load_state_dict(torch.load('path/to/student.pth'))
+    student.load_state_dict(load_weights('path/to/student.safetensors'))
     
     
     # create loss function
@@ -419,9 +421,10 @@ class Distiller(object):
                                        self.T_criterion, optimizer, scheduler, 
                                        epochs_unfreeze, ckpt)
         
-        last_teacher = osp.join(folder_save, '{}_last.pth'.format(
+        last_teacher = osp.join(folder_save, '{}_last.safetensors'.format(
             self.teacher.__class__.__name__))
-        torch.save(self.teacher.state_dict(), last_teacher)
+        save_async(snapshot(self.teacher), last_teacher)
+        wait_saves()
         time_elapsed = time() - since
         print('TEACHER TRAINING TIME {} m {:.3f}s'.format(
             time_elapsed//60, time_elapsed % 60))
@@ -459,8 +462,9 @@ class Distiller(object):
                                           self.S_criterion, optimizer, scheduler,
                                           epochs_unfreeze, ckpt)
         
-        last_student = osp.join(folder_save, '{}_last.pth'.format(model_name))
-        torch.save(self.student.state_dict(), last_student)
+        last_student = osp.join(folder_save, '{}_last.safetensors'.format(model_name))
+        save_async(snapshot(self.student), last_student)
+        wait_saves()
         time_elapsed = time() - since
         print('STUDENT TRAINING TIME {} m {:.3f}s'.format(
             time_elapsed//60, time_elapsed % 60))
@@ -0,0 +1,82 @@
+import os
+from contextlib import nullcontext
+from typing import ContextManager, Dict
+
+import torch
+import torch.distributed as dist
+from torch import Tensor, nn
+from torch.nn.parallel import DistributedDataParallel as DDP
+from torch.utils.data import DataLoader, Dataset, DistributedSampler
+
+# https://pytorch.org/tutorials/intermediate/ddp_tutorial.html
+
+
+def setup(rank:int, world_size:int, backend:str='nccl') -> torch.device:
+    r"""
+    join the process group, one process per GPU
+    Returns:
+        device of this rank, cuda:<rank>
+    """
+    os.environ.setdefault('MASTER_ADDR', 'localhost')
+    os.environ.setdefault('MASTER_PORT', '29500')
+    dist.init_process_group(backend=backend, rank=rank, world_size=world_size)
+    torch.cuda.set_device(rank)
+    return torch.device('cuda:{}'.format(rank))
+
+
+def cleanup() -> None:
+    dist.destroy_process_group()
+
+
+def is_distributed() -> bool:
+    return dist.is_available() and dist.is_initialized()
+
+
+def is_main_process() -> bool:
+    return not is_distributed() or dist.get_rank() == 0
+
+
+def all_reduce_(tensor:Tensor) -> Tensor:
+    r"""sum `tensor` over all ranks in place, no-op on a single process"""
+    if is_distributed():
+        dist.all_reduce(tensor, op=dist.ReduceOp.SUM)
+    return tensor
+
+
+def wrap(model:nn.Module, device:torch.device) -> nn.Module:
+    r"""wrap `model` in DDP when a process group is running"""
+    if not is_distributed():
+        return model
+    return DDP(model, device_ids=[device] if device.type == 'cuda' else None)
+
+
+def unwrap(model:nn.Module) -> nn.Module:
+    r"""
+    module without torch.compile / DDP wrappers,
+    its state_dict has no '_orig_mod.' or 'module.' prefix
+    """
+    model = getattr(model, '_orig_mod', model)
+    return model.module if isinstance(model, DDP) else model
+
+
+def no_sync(model:nn.Module, skip:bool) -> ContextManager:
+    r"""
+    model.no_sync() when `skip` and `model` is DDP, so gradient accumulation
+    all-reduces once at the optimizer step instead of after every micro batch
+    """
+    ddp = getattr(model, '_orig_mod', model)
+    return ddp.no_sync() if skip and isinstance(ddp, DDP) else nullcontext()
+
+
+def make_loaders(datasets:Dict[str, Dataset], batch_size:int, num_workers:int=0
+                 ) -> Dict[str, DataLoader]:
+    r"""
+    DataLoaders that give each rank its own shard of every dataset,
+    only the train shard is shuffled (call sampler.set_epoch each epoch) and
+    drops its tail batch so compiled / graphed steps keep one shape
+    """
+    return {phase: DataLoader(dataset, batch_size, num_workers=num_workers, pin_memory=True,
+                              sampler=DistributedSampler(dataset, shuffle=phase == 'train'),
+                              drop_last=phase == 'train', persistent_workers=num_workers > 0,
+                              prefetch_factor=4 if num_workers > 0 else None)
+            for phase, dataset in datasets.items()}
@@ -0,0 +1,182 @@
+import os
+from typing import Callable, Optional, Tuple
+
+import torch
+from torch import Tensor, nn, optim
+from torch.utils.data import DataLoader, DistributedSampler
+from tqdm import tqdm
+
+from distiller.cuda_graph import capture_train_step
+from distiller.distributed import all_reduce_, is_distributed, is_main_process, no_sync, wrap
+
+pbar_every:int = 16
+
+
+def set_backend_flags() -> None:
+    r"""inputs are resized to a fixed shape, let cudnn autotune once and use TF32 on Ampere+"""
+    torch.backends.cudnn.benchmark = True
+    torch.backends.cuda.matmul.allow_tf32 = True
+    torch.backends.cudnn.allow_tf32 = True
+
+
+def prepare(module:nn.Module, device:torch.device, compile_mode:str=None) -> nn.Module:
+    r"""
+    move `module` to `device` as channels_last (NHWC lets cudnn pick tensor core
+    kernels without transposes), wrap it in DDP and torch.compile it if asked.
+    'reduce-overhead' also records CUDA graphs, 'default' only fuses kernels
+    """
+    module.to(device, memory_format=torch.channels_last)
+    model = wrap(module, device)
+    if compile_mode:
+        model = torch.compile(model, mode=compile_mode, fullgraph=False)
+    return model
+
+
+def make_optimizer(module:nn.Module, device:torch.device, cuda_graph:bool=False) -> optim.Adam:
+    r"""
+    Adam over the classifier (last child) of `module`, fused on CUDA.
+    With `cuda_graph` the lr is a tensor: a float would be baked into the graph
+    at capture, a tensor is read at every replay and the schedulers fill_() it
+    """
+    lr = torch.tensor(0.001, device=device) if cuda_graph else 0.001
+    return optim.Adam(list(module.children())[-1].parameters(), lr=lr,
+                      betas=(0.9, 0.999), eps=1e-08, weight_decay=1e-5,
+                      capturable=cuda_graph, fused=device.type == 'cuda')
+
+
+def unfreeze(module:nn.Module, optimizer:optim.Optimizer,
+             lr:float=0.0001, weight_decay:float=0) -> None:
+    r"""
+    make every layer of `module` trainable and add the new ones to `optimizer`,
+    the classifier keeps its Adam state
+    """
+    for param_group in optimizer.param_groups:
+        if isinstance(param_group['lr'], Tensor): # see make_optimizer
+            param_group['lr'].fill_(lr)
+        else:
+            param_group['lr'] = lr
+        param_group['weight_decay'] = weight_decay
+    group_lr = optimizer.param_groups[0]['lr']
+    existing_ids = {id(p) for group in optimizer.param_groups for p in group['params']}
+    for param in module.parameters():
+        param.requires_grad = True
+    # a tensor lr gets its own copy, the scheduler fills every group separately
+    optimizer.add_param_group({'params': [p for p in module.parameters() if id(p) not in existing_ids],
+                               'lr': group_lr.clone() if isinstance(group_lr, Tensor) else lr,
+                               'weight_decay': weight_decay})
+
+
+class Engine(object):
+    r"""
+    Train / val epochs shared by the teacher and the student trainers.
+    Args:
+        model: module to run, may be DDP wrapped or compiled
+        forward_loss: (datas, targets) -> (outp, loss summed over the batch),
+            runs autocast itself
+        optimizer, scaler: scaler disabled for bfloat16 or on CPU
+        cuda_graph: replay forward, backward and optimizer step as one CUDA graph,
+            batches of another size than the first one are skipped
+        accum_steps: micro batches per optimizer step
+    """
+    def __init__(self, model:nn.Module, forward_loss:Callable[[Tensor, Tensor], Tuple[Tensor, Tensor]],
+                 optimizer:optim.Optimizer, scaler:torch.amp.GradScaler, device:torch.device,
+                 cuda_graph:bool=False, accum_steps:int=1):
+        assert not (cuda_graph and scaler.is_enabled()), \
+            'GradScaler syncs with host in step(), use amp_dtype=torch.bfloat16 with cuda_graph'
+        assert not (cuda_graph and accum_steps > 1), 'cuda_graph steps the optimizer every batch'
+        assert not (cuda_graph and is_distributed()), \
+            'capturing the DDP all-reduce needs a side-stream DDP and 11+ eager warmup steps'
+        self.model = model
+        self.forward_loss = forward_loss
+        self.optimizer = optimizer
+        self.scaler = scaler
+        self.device = device
+        self.cuda_graph = cuda_graph
+        self.accum_steps = accum_steps
+        self.graph = None
+
+    def _forward_mean_loss(self, datas:Tensor, targets:Tensor) -> Tuple[Tensor, Tensor]:
+        outp, loss = self.forward_loss(datas, targets)
+        return outp, loss / datas.size(0)
+
+    def _graph_step(self, datas:Tensor, targets:Tensor) -> Optional[Tuple[Tensor, Tensor]]:
+        if self.graph is None:
+            self.graph, self.static_inputs, self.static_outp, self.static_loss = \
+                capture_train_step(self._forward_mean_loss, self.model, self.optimizer,
+                                   datas, targets)
+        elif datas.size(0) != self.static_inputs[0].size(0):
+            return None # the graph replays fixed shapes only
+        for static, x in zip(self.static_inputs, (datas, targets)):
+            static.copy_(x)
+        self.graph.replay()
+        return self.static_outp, self.static_loss * datas.size(0)
+
+    def _step(self, datas:Tensor, targets:Tensor, step:bool, window:int) -> Tuple[Tensor, Tensor]:
+        with no_sync(self.model, skip=not step):
+            outp, loss = self.forward_loss(datas, targets)
+            self.scaler.scale(loss / (datas.size(0)*window)).backward()
+        if step:
+            self.scaler.step(self.optimizer)
+            self.scaler.update()
+            self.optimizer.zero_grad(set_to_none=True)
+        return outp, loss
+
+    def run(self, loader:DataLoader, phase:str, epoch:int,
+            colour:str='green', on_batch:Callable[[], None]=None) -> Tuple[float, float]:
+        r"""
+        one `phase` epoch over `loader`, `on_batch()` is called after each train batch
+        Returns:
+            epoch_loss, epoch_acc (0. in train, its accuracy is not monitored)
+        """
+        is_train = phase == 'train'
+        self.model.train(is_train)
+        if isinstance(loader.sampler, DistributedSampler):
+            loader.sampler.set_epoch(epoch)
+        if is_train and not self.cuda_graph: # the graph owns its grads
+            self.optimizer.zero_grad(set_to_none=True)
+
+        # accumulate on device, .item() once per epoch instead of once per batch
+        running_loss = torch.zeros((), device=self.device)
+        running_corrects = torch.zeros((), dtype=torch.long, device=self.device)
+        seen = 0
+
+        # redraw at most once a second, the bar is per-batch python work
+        pbar = tqdm(total=len(loader), ncols=64, colour=colour,
+                    desc='{:6}'.format(phase).capitalize(), mininterval=1.0,
+                    disable=bool(os.environ.get('NO_TQDM')) or not is_main_process())
+        for idx, (datas, targets) in enumerate(loader, start=1):
+            if not idx % pbar_every: pbar.update(pbar_every)
+            datas = datas.to(self.device, non_blocking=True, memory_format=torch.channels_last)
+            targets = targets.to(self.device, non_blocking=True)
+
+            if is_train and self.cuda_graph:
+                result = self._graph_step(datas, targets)
+                if result is None:
+                    continue
+                outp, loss = result
+            elif is_train:
+                # step every accum_steps micro batches and on the last one,
+                # the tail window averages over its own, fewer, micro batches
+                window_start = (idx - 1) // self.accum_steps * self.accum_steps
+                outp, loss = self._step(datas, targets,
+                                        step=not idx % self.accum_steps or idx == len(loader),
+                                        window=min(self.accum_steps, len(loader) - window_start))
+            else:
+                with torch.inference_mode():
+                    outp, loss = self.forward_loss(datas, targets)
+
+            running_loss += loss.detach()
+            seen += targets.size(0)
+            if is_train:
+                if on_batch is not None: on_batch()
+            else:
+                running_corrects += (outp.argmax(1) == targets).sum()
+        pbar.update(pbar.total - pbar.n)
+        pbar.close()
+
+        # sum the shards of every rank, divide by the samples actually seen:
+        # DistributedSampler pads val with duplicates, the graph skips the tail batch
+        all_reduce_(running_loss)
+        all_reduce_(running_corrects)
+        seen = all_reduce_(torch.tensor(seen, device=self.device)).item()
+        return (running_loss / seen).item(), running_corrects.item() / seen
@@ -1,16 +1,13 @@
 import torch
 import torch.nn as nn
-import torch.optim as optim
 import torch.optim.lr_scheduler as lr_scheduler
-# from torch.utils.data import DataLoader
-import os
-import os.path as osp
-import copy
 from colorama import Fore
-from tqdm import tqdm
 from time import time
 
 # from prepare_dataloader import loaders, dataset_sizes
+from distiller.checkpoint import save_async, snapshot, wait_saves
+from distiller.distributed import cleanup, is_main_process, make_loaders, setup
+from distiller.engine import Engine, make_optimizer, prepare, set_backend_flags, unfreeze
 from distiller.loss import loss_fn_kd
 from distiller.print_utils import print_msg, print_time
 
@@ -19,105 +16,122 @@ device = torch.device('cuda:0' if torch.cuda.is_available() else 'cpu')
 
 def train_kd(student:nn.Module, teacher:nn.Module, best_acc:float=0.0,
           criterion=loss_fn_kd, optimizer= ..., scheduler= ..., 
-          epochs:int= 12, loaders:dict=..., dataset_sizes:dict=...,
-          path_save_weight:str= ...
+          epochs:int= 12, loaders:dict=...,
+          path_save_weight:str= ..., amp_dtype:torch.dtype=torch.float16,
+          cuda_graph:bool=False, device:torch.device=device,
+          accum_steps:int=1, scaler:torch.amp.GradScaler=None
           ) -> tuple:
     
     since = time()
-    best_student = copy.deepcopy(student)
-    
-    for epoch in range(1, epochs+1): 
-        for phase in ('train', 'val'):
-            if phase == 'train': 
-                student.train()
-                print(Fore.RED); print('Epoch : {:>2d}/{:<2d}'.format(
-                    epoch, epochs), Fore.RESET, ' {:>48}'.format('='*46))
-            else:
-                student.eval()
-
-            running_loss = 0.0
-            running_corrects = 0.0
+    use_amp = device.type == 'cuda'
+    if scaler is None:
+        scaler = torch.amp.GradScaler('cuda', enabled=use_amp and amp_dtype == torch.float16)
+    best_state = None # stays None if no epoch beats best_acc
 
-            for datas, targets in tqdm(loaders[phase], ncols=64, colour='black', 
-                                       desc='{:6}'.format(phase).capitalize()):
-                datas, targets = datas.to(device), targets.to(device)
-                
-                optimizer.zero_grad()
-                # with torch.no_grad:
+    def forward_loss(datas, targets):
+        with torch.autocast(device.type, dtype=amp_dtype, enabled=use_amp, 
+                            cache_enabled=not cuda_graph):
+            with torch.no_grad():
                 outp_Teacher = teacher(datas).detach()
-                
-                with torch.set_grad_enabled(phase == 'train'):
-                    outp_Student = student(datas)
-                    # outp_Teacher = teacher(datas)
-                    
-                    loss = criterion(outp_Student, targets, outp_Teacher, 
-                                     T = 6, alpha = 0.1)
-                    _, pred = torch.max(outp_Student, 1)
-                    
-                    if phase == 'train':
-                        loss.backward()
-                        optimizer.step()
+            outp_Student = student(datas)
+            loss = criterion(outp_Student, targets, outp_Teacher, T = 6, alpha = 0.1)
+            return outp_Student, loss * datas.size(0)
+    
+    engine = Engine(student, forward_loss, optimizer, scaler, device, cuda_graph, accum_steps)
+    for epoch in range(1, epochs+1): 
+        print(Fore.RED); print('Epoch : {:>2d}/{:<2d}'.format(
+            epoch, epochs), Fore.RESET, ' {:>48}'.format('='*46))
+        epoch_loss, _ = engine.run(loaders['train'], 'train', epoch, 'black')
+        print('{} - loss = {:.6f}'.format('Train', epoch_loss))
 
-                running_loss += loss.item()*datas.size(0)
-                running_corrects += torch.sum(pred == targets.data)
-                
-            epoch_loss = running_loss / dataset_sizes[phase]
-            epoch_acc = running_corrects.double() / dataset_sizes[phase]
+        epoch_loss, epoch_acc = engine.run(loaders['val'], 'val', epoch, 'black')
+        scheduler.step(100. * epoch_acc) #val acc
+        print('{} - loss = {:.6f}, accuracy = {:.3f}'.format('Val  ', epoch_loss, 100*epoch_acc))
+        time_elapsed = time() - since
+        print('Time: {}m {:.3f}s'.format(
+            time_elapsed // 60, time_elapsed % 60))
             
-            if phase == 'train':
-                scheduler.step(100. * epoch_acc) #acc
-                
-            print('{} - loss = {:.6f}, accuracy = {:.3f}'.format(
-                '{:5}'.format(phase).capitalize(), epoch_loss, 100*epoch_acc))
-
-            if phase == 'val':
-                time_elapsed = time() - since
-                print('Time: {}m {:.3f}s'.format(
-                    time_elapsed // 60, time_elapsed % 60))
-                
-            if phase == 'val' and epoch_acc > best_acc:
-                best_acc = epoch_acc
-                best_student = copy.deepcopy(student)
-                torch.save(student.state_dict(), path_save_weight)
+        if epoch_acc > best_acc:
+            best_acc = epoch_acc
+            best_state = snapshot(student)
+            if is_main_process():
+                save_async(best_state, path_save_weight)
         
-    return best_student, best_acc
+    return best_state, best_acc
 
 
 def training_kd(student:nn.Module, teacher:nn.Module, 
+                loaders:dict,
                 epochs_freeze:int = 8, epochs_unfreeze:int = 12, 
-                path_save_weight:str=None):
+                path_save_weight:str=None, amp_dtype:torch.dtype=torch.float16,
+                cuda_graph:bool=False, device:torch.device=device,
+                compile_mode:str=None, accum_steps:int=1):
+    assert not (cuda_graph and compile_mode), 'use either cuda_graph or compile_mode'
+    assert path_save_weight.endswith('.safetensors'), \
+        'weights are written with safetensors, load them with checkpoint.load_weights'
 
-    student.to(device); teacher.to(device).eval()
+    set_backend_flags()
+    teacher.to(device, memory_format=torch.channels_last).eval()
+    model = prepare(student, device, compile_mode)
     criterion = loss_fn_kd
-    optimizer = optim.Adam(list(student.children())[-1].parameters(), lr=0.001, 
-                           betas=(0.9, 0.999), eps=1e-08, weight_decay=1e-5)
+    # one scaler for both phases, its scale carries over the unfreeze
+    scaler = torch.amp.GradScaler(
+        'cuda', enabled=device.type == 'cuda' and amp_dtype == torch.float16)
+    optimizer = make_optimizer(student, device, cuda_graph)
     scheduler = lr_scheduler.ReduceLROnPlateau(optimizer, mode='max', factor=0.2, 
                                                patience=3, verbose=True)
     
     since = time()
-    best_acc = 0.0
+    best_acc = -1.0
     
-    student, best_acc = train_kd(student, teacher, best_acc, 
-                                 criterion, optimizer, scheduler, 
-                                 epochs_freeze, path_save_weight)
+    best_state, best_acc = train_kd(model, teacher, best_acc, 
+                                    criterion, optimizer, scheduler, 
+                                    epochs_freeze, loaders,
+                                    path_save_weight, amp_dtype, cuda_graph, device,
+                                    accum_steps, scaler)
+    # load in place, the DDP wrapper keeps pointing at student
+    if best_state is not None:
+        student.load_state_dict(best_state)
     print(end='\n')
     print_time('FREEZE TRAINING TIME', time() - since)
     print_msg("Unfreeze all layers", teacher.__class__.__name__)
 
-    # unfrezz all layer
-    for param in student.parameters():
-        param.requires_grad = True
-
-    optimizer = optim.Adam(student.parameters(), lr=0.0001, 
-                           betas=(0.9, 0.999), eps=1e-08, weight_decay=0)
-    scheduler = lr_scheduler.ReduceLROnPlateau(optimizer, factor=0.2, 
+    unfreeze(student, optimizer)
+    # DDP only reduces the parameters that required grad when it was built
+    model = prepare(student, device, compile_mode)
+    scheduler = lr_scheduler.ReduceLROnPlateau(optimizer, mode='max', factor=0.2, 
                                                patience=2, verbose=True)
     
-    student, best_acc = train_kd(student, teacher, best_acc,
-                                 criterion, optimizer, scheduler, 
-                                 epochs_unfreeze, path_save_weight)
+    state, best_acc = train_kd(model, teacher, best_acc,
+                               criterion, optimizer, scheduler, 
+                               epochs_unfreeze, loaders,
+                               path_save_weight, amp_dtype, cuda_graph, device,
+                               accum_steps, scaler)
+    if state is not None: # None when no epoch beat the classifier phase
+        best_state = state
+    if best_state is not None:
+        student.load_state_dict(best_state)
     
-    torch.save(student.state_dict(), path_save_weight)
+    if best_state is not None and is_main_process():
+        save_async(best_state, path_save_weight)
+        wait_saves()
     print_time('ALL TRAINING TIME', time() - since)
     
     return student
+
+
+def main_worker_kd(rank:int, world_size:int, datasets:dict,
+                   batch_size:int, num_workers:int, student:nn.Module, teacher:nn.Module,
+                   epochs_freeze:int = 8, epochs_unfreeze:int = 12, 
+                   path_save_weight:str=None, kwargs:dict=None) -> None:
+    r"""
+    DistributedDataParallel entry point, one process per GPU
+        mp.spawn(main_worker_kd, nprocs=world_size, args=(world_size, datasets,
+                 batch_size, n_workers, student, teacher))
+    batch_size is per GPU, kwargs (a dict, spawn passes args positionally) go to training_kd()
+    """
+    device = setup(rank, world_size)
+    loaders = make_loaders(datasets, batch_size, num_workers)
+    training_kd(student, teacher, loaders, epochs_freeze, epochs_unfreeze,
+                path_save_weight, device=device, **(kwargs or {}))
+    cleanup()
@@ -1,18 +1,20 @@
-import copy
 import os
 import os.path as osp
 from time import time
 from colorama import Fore
-from tqdm import tqdm
-from typing import Tuple, Dict
+from typing import Any, Dict, Optional, Tuple
 
 import torch
 import torch.nn as nn
+import torch.nn.functional as F
 import torch.optim as optim
 import torch.optim.lr_scheduler as lr_scheduler
-from torch.nn.modules.loss import _Loss
-from torch.utils.data import DataLoader
+from torch import Tensor
+from torch.utils.data import DataLoader, Dataset
 
+from distiller.checkpoint import save_async, snapshot, wait_saves
+from distiller.distributed import cleanup, is_main_process, make_loaders, setup
+from distiller.engine import Engine, make_optimizer, prepare, set_backend_flags, unfreeze
 from distiller.print_utils import print_msg
 
 # device = torch.device('cuda:0' if torch.cuda.is_available() else 'cpu')
@@ -20,124 +22,133 @@ folder_save = 'weights'
 if not osp.isdir(folder_save): os.makedirs(folder_save)
 batch_num:int = 0
 
-def train(loaders:Dict[str, DataLoader], dataset_sizes:Dict[str, int], device:torch.device,
-          teacher:nn.Module, best_teacher:nn.Module, best_acc:float, 
-          criterion:_Loss, optimizer:optim.Optimizer, scheduler, 
-          epochs:int, model_name:str, ckpt:int=20
-          ) -> Tuple[nn.Module, float]:
+def train(loaders:Dict[str, DataLoader], device:torch.device,
+          teacher:nn.Module, best_state:Optional[Dict[str, Tensor]], best_acc:float, 
+          optimizer:optim.Optimizer, scheduler, 
+          epochs:int, model_name:str, ckpt:int=20,
+          scaler:torch.amp.GradScaler=None, amp_dtype:torch.dtype=torch.float16,
+          cuda_graph:bool=False, accum_steps:int=1
+          ) -> Tuple[Optional[Dict[str, Tensor]], float]:
     
-    global batch_num
     since = time()
-    
+    use_amp = device.type == 'cuda'
+    if scaler is None:
+        scaler = torch.amp.GradScaler('cuda', enabled=use_amp and amp_dtype == torch.float16)
+
+    def forward_loss(datas:Tensor, targets:Tensor) -> Tuple[Tensor, Tensor]:
+        # autocast cache must be off while a CUDA graph is captured
+        with torch.autocast(device.type, dtype=amp_dtype, enabled=use_amp, 
+                            cache_enabled=not cuda_graph):
+            outp = teacher(datas)
+            # summed over the batch, the train step divides by the batch size itself
+            return outp, F.cross_entropy(outp, targets, reduction='sum')
+
+    def save_ckpt() -> None:
+        global batch_num
+        batch_num += 1
+        if not batch_num % ckpt and is_main_process():
+            path_save = osp.join(folder_save, '{}_{}.safetensors'.format(model_name, batch_num))
+            save_async(snapshot(teacher), path_save)
+
+    engine = Engine(teacher, forward_loss, optimizer, scaler, device, cuda_graph, accum_steps)
     for epoch in range(1, epochs+1):
-        for phase in ('train', 'val'):
-            if phase == 'train': 
-                teacher.train()
-                print(Fore.RED); print('Epoch : {:>2d}/{:<2d}'.format(
-                    epoch, epochs), Fore.RESET, ' {:>48}'.format('='*46))
-            else:
-                teacher.eval()
-
-            running_loss = 0.0
-            running_corrects = 0.0
-
-            for datas, targets in tqdm(loaders[phase], ncols=64, colour='green', 
-                                       desc='{:6}'.format(phase).capitalize()):
-                
-                if phase == 'train': batch_num += 1
-                
-                datas, targets = datas.to(device), targets.to(device)
-
-                optimizer.zero_grad()
-
-                with torch.set_grad_enabled(phase == 'train'):
-                    outp = teacher(datas)
-                    _, pred = torch.max(outp, 1)
-                    loss = criterion(outp, targets)
-
-                    if phase == 'train':
-                        loss.backward()
-                        optimizer.step()
-
-                running_loss += loss.item()*datas.size(0)
-                running_corrects += torch.sum(pred == targets.data)
-                
-                #save checkpoint
-                if not batch_num % ckpt:
-                    path_save = osp.join(folder_save, '{}_{}.pth'.format(model_name, batch_num))
-                    torch.save(teacher.state_dict(), path_save)
-                    
-            epoch_loss = running_loss / dataset_sizes[phase]
-            epoch_acc = running_corrects.double() / dataset_sizes[phase]
+        print(Fore.RED); print('Epoch : {:>2d}/{:<2d}'.format(
+            epoch, epochs), Fore.RESET, ' {:>48}'.format('='*46))
+        epoch_loss, _ = engine.run(loaders['train'], 'train', epoch, 'green',
+                                   on_batch=save_ckpt)
+        print('{} - loss = {:.6f}'.format('Train', epoch_loss))
+
+        epoch_loss, epoch_acc = engine.run(loaders['val'], 'val', epoch, 'green')
+        scheduler.step(100. * epoch_acc) #val acc
+        print('{} - loss = {:.6f}, accuracy = {:.3f}'.format('Val  ', epoch_loss, 100*epoch_acc))
+        time_elapsed = time() - since
+        print('Time: {}m {:.3f}s'.format(
+            time_elapsed // 60, time_elapsed % 60))
             
-            if phase == 'train':
-                scheduler.step(100. * epoch_acc) #acc
-                
-            print('{} - loss = {:.6f}, accuracy = {:.3f}'.format(
-                '{:5}'.format(phase).capitalize(), epoch_loss, 100*epoch_acc))
-
-            if phase == 'val':
-                time_elapsed = time() - since
-                print('Time: {}m {:.3f}s'.format(
-                    time_elapsed // 60, time_elapsed % 60))
-                
-            if phase == 'val' and epoch_acc > best_acc:
-                best_acc = epoch_acc
-                best_teacher = copy.deepcopy(teacher)
-                path_save = osp.join(folder_save, '{}_best.pth'.format(model_name))
-                torch.save(teacher.state_dict(), path_save)
-    return best_teacher, best_acc
+        if epoch_acc > best_acc:
+            best_acc = epoch_acc
+            best_state = snapshot(teacher)
+            if is_main_process():
+                path_save = osp.join(folder_save, '{}_best.safetensors'.format(model_name))
+                save_async(best_state, path_save)
+    return best_state, best_acc
 
 
 def training(loaders:Dict[str, DataLoader], dataset_sizes:Dict[str, int], device:torch.device,
              epochs_freeze:int, epochs_unfreeze:int, 
-             teacher:nn.Module, model_name:str, ckpt:int=20
+             teacher:nn.Module, model_name:str, ckpt:int=20,
+             amp_dtype:torch.dtype=torch.float16, cuda_graph:bool=False,
+             compile_mode:str=None, accum_steps:int=1
              ) -> nn.Module:
     
     assert len(loaders) >=2 and len(dataset_sizes) >=2, 'please check loaders'
-    print('Training {} on {}'.format(model_name, torch.cuda.get_device_name(0)))
-
-    teacher.to(device)
-    criterion = nn.CrossEntropyLoss()
-    optimizer = optim.Adam(list(teacher.children())[-1].parameters(), lr=0.001, 
-                           betas=(0.9, 0.999), eps=1e-08, weight_decay=1e-5)
+    assert not (cuda_graph and compile_mode), 'use either cuda_graph or compile_mode'
+    print('Training {} on {}'.format(model_name, torch.cuda.get_device_name(device)
+                                      if device.type == 'cuda' else 'cpu'))
+    set_backend_flags()
+    model = prepare(teacher, device, compile_mode)
+    scaler = torch.amp.GradScaler(
+        'cuda', enabled=device.type == 'cuda' and amp_dtype == torch.float16)
+    optimizer = make_optimizer(teacher, device, cuda_graph)
     scheduler = lr_scheduler.ReduceLROnPlateau(optimizer, mode='max', factor=0.2, 
                                                patience=3, verbose=True)
     
     since = time()
-    best_teacher = copy.deepcopy(teacher)
-    best_acc = 0.0
+    # the first val epoch always beats -1
+    best_state = None
+    best_acc = -1.0
     
-    best_teacher, best_acc = train(loaders, dataset_sizes, device,
-                                   teacher, best_teacher, best_acc, 
-                                   criterion, optimizer, scheduler, 
-                                   epochs_freeze, model_name, ckpt)
+    best_state, best_acc = train(loaders, device,
+                                 model, best_state, best_acc, 
+                                 optimizer, scheduler, 
+                                 epochs_freeze, model_name, ckpt,
+                                 scaler, amp_dtype, cuda_graph, accum_steps)
+    if best_state is not None:
+        teacher.load_state_dict(best_state)
 
     time_elapsed = time() - since
     print('CLASSIFIER TRAINING TIME {} : {:.3f}'.format(
         time_elapsed//60, time_elapsed % 60))
     print_msg("Unfreeze all layers", teacher.__class__.__name__)
 
-    teacher.load_state_dict(best_teacher.state_dict())
-
-    # unfrezz all layer
-    for param in teacher.parameters():
-        param.requires_grad = True
-
-    optimizer = optim.Adam(teacher.parameters(), lr=0.0001, 
-                           betas=(0.9, 0.999), eps=1e-08, weight_decay=0)
-    scheduler = lr_scheduler.ReduceLROnPlateau(optimizer, factor=0.2, 
+    unfreeze(teacher, optimizer)
+    # DDP only reduces the parameters that required grad when it was built
+    model = prepare(teacher, device, compile_mode)
+    scheduler = lr_scheduler.ReduceLROnPlateau(optimizer, mode='max', factor=0.2, 
                                                patience=2, verbose=True)
     
-    best_teacher, best_acc = train(loaders, dataset_sizes,
-                                   teacher, best_teacher, best_acc, 
-                                   criterion, optimizer, scheduler, 
-                                   epochs_unfreeze, model_name, ckpt)
+    best_state, best_acc = train(loaders, device,
+                                 model, best_state, best_acc, 
+                                 optimizer, scheduler, 
+                                 epochs_unfreeze, model_name, ckpt,
+                                 scaler, amp_dtype, cuda_graph, accum_steps)
+    if best_state is not None:
+        teacher.load_state_dict(best_state)
     
-    last_teacher = osp.join(folder_save, '{}_last.pth'.format(model_name))
-    torch.save(best_teacher.state_dict(), last_teacher)
+    if best_state is not None and is_main_process():
+        last_teacher = osp.join(folder_save, '{}_last.safetensors'.format(model_name))
+        save_async(best_state, last_teacher)
+        wait_saves()
     time_elapsed = time() - since
     print('ALL NET TRAINING TIME {} m {:.3f}s'.format(
         time_elapsed//60, time_elapsed % 60))
 
-    return best_teacher
+    return teacher
+
+
+def main_worker(rank:int, world_size:int, datasets:Dict[str, Dataset], 
+                dataset_sizes:Dict[str, int], batch_size:int, num_workers:int,
+                epochs_freeze:int, epochs_unfreeze:int, 
+                teacher:nn.Module, model_name:str, ckpt:int=20, 
+                kwargs:Dict[str, Any]=None) -> None:
+    r"""
+    DistributedDataParallel entry point, one process per GPU
+        mp.spawn(main_worker, nprocs=world_size, args=(world_size, datasets, dataset_sizes, 
+                 batch_size, n_workers, epochs_freeze, epochs_unfreeze, teacher, model_name))
+    batch_size is per GPU, kwargs (a dict, spawn passes args positionally) go to training()
+    """
+    device = setup(rank, world_size)
+    loaders = make_loaders(datasets, batch_size, num_workers)
+    training(loaders, dataset_sizes, device, epochs_freeze, epochs_unfreeze, 
+             teacher, model_name, ckpt, **(kwargs or {}))
+    cleanup()
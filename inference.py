@@ -9,6 +9,7 @@ import numpy as np
 import cv2
 # from scipy.special import softmax
 from distiller.loss import softmax
+from distiller.checkpoint import load_weights
 from typing import Tuple
 # from prepare_dataloader import loaders
 
@@ -27,11 +28,10 @@ class Student(object):
         # device and load weight
         if torch.cuda.is_available():
             self.device = torch.device('cuda:0')
-            self.model.load_state_dict(torch.load('weights/student.pth'))
         else:
             self.device = torch.device('cpu')
-            self.model.load_state_dict(
-                torch.load('weights/student.pth', map_location=self.device))
+        self.model.load_state_dict(
+            load_weights('weights/student.pth', device=self.device))
         self.model.to(self.device).eval()
         
         # tranform datas
@@ -91,7 +91,7 @@ set_image_backend('accimage')
 dataset_root = 'dataset/intel-image-classification/seg_train'
 batch_size = 8
 
-n_workers = os.cpu_count()
+n_workers = max(4, os.cpu_count() // 2)
 lr = 0.001
 temperature = 6
 alpha = 0.1
@@ -193,12 +193,22 @@ train_size = len(train_val) - val_size
 train, val = random_split(train_val, [train_size, val_size], generator=generator)
 
 loaders = {
-'train':DataLoader(train, batch_size, shuffle=True, num_workers=n_workers, pin_memory=True, generator=generator),
-'val':DataLoader(val, batch_size, shuffle=True, num_workers=n_workers, pin_memory=True, generator=generator),
-'test':DataLoader(test, batch_size, shuffle=True, num_workers=n_workers, pin_memory=True, generator=generator)
+'train':DataLoader(train, batch_size, shuffle=True, num_workers=n_workers, pin_memory=True, generator=generator, drop_last=True,
+                   persistent_workers=True, prefetch_factor=4),
+'val':DataLoader(val, batch_size, shuffle=True, num_workers=n_workers, pin_memory=True, generator=generator,
+                 persistent_workers=True, prefetch_factor=4),
+'test':DataLoader(test, batch_size, shuffle=True, num_workers=n_workers, pin_memory=True, generator=generator,
+                  persistent_workers=True, prefetch_factor=4)
 }
 del generator
 
+# for DistributedSampler loaders, see distiller.distributed.make_loaders
+datasets = {
+    'train': train,
+    'val': val,
+    'test': test,
+}
+
 dataset_sizes = {
     'train': train_size,
     'val': val_size,
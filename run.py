@@ -1,13 +1,35 @@
-from prepare_dataloader import loaders, dataset_sizes, num_classes
-from distiller.teacher_train import training
+from prepare_dataloader import loaders, datasets, dataset_sizes, batch_size, n_workers, num_classes
+from distiller.teacher_train import training, main_worker
 # from models.model import teacher#, student
 
+import argparse
+import torch
 import torch.nn as nn
+import torch.multiprocessing as mp
 from torchvision.models import resnet18
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--amp-dtype', default='float16', choices=('float16', 'bfloat16'),
+                        help='autocast dtype, bfloat16 runs without GradScaler')
+    parser.add_argument('--compile-mode', default=None, 
+                        choices=('default', 'reduce-overhead', 'max-autotune'),
+                        help='torch.compile the model, off by default')
+    args = parser.parse_args()
+    train_kwargs = {'amp_dtype': getattr(torch, args.amp_dtype), 'compile_mode': args.compile_mode}
+
     teacher = resnet18(pretrained=True, progress=True)
     teacher.fc = nn.Linear(in_features=teacher.fc.in_features,
                        out_features=num_classes, bias=True)
-    teacher = training(loaders, dataset_sizes, 2, 2, teacher, r"weights/teacher.pth")
-    print(teacher)
\ No newline at end of file
+
+    world_size = torch.cuda.device_count()
+    if world_size > 1:
+        # one DDP process per GPU, weights are saved by rank 0
+        mp.spawn(main_worker, nprocs=world_size,
+                 args=(world_size, datasets, dataset_sizes, batch_size, n_workers // world_size,
+                       2, 2, teacher, 'teacher', 20, train_kwargs))
+    else:
+        device = torch.device('cuda:0' if torch.cuda.is_available() else 'cpu')
+        teacher = training(loaders, dataset_sizes, device, 2, 2, teacher, 'teacher',
+                           **train_kwargs)
+        print(teacher)
@@ -2,6 +2,7 @@ import torch
 import torch.nn as nn
 from torchvision.models import resnet18, resnet34
 
+from distiller.checkpoint import load_weights
 from distiller.distiller import Distiller
 from distiller.loss import KDLoss
 from distiller.teacher_train import training
@@ -14,7 +15,7 @@ if __name__ == "__main__":
     teacher = resnet34(pretrained=False, progress=True)
     teacher.fc = nn.Linear(in_features=teacher.fc.in_features,
                            out_features=num_classes, bias=True)
-    teacher.load_state_dict(torch.load('weights/teacher.pth'))
+    teacher.load_state_dict(load_weights('weights/teacher.pth'))
     # teacher = training(loaders, dataset_sizes, 2, 2, teacher, r"weights/teacher.pth")
     # print(teacher)
     